@@ -1,7 +1,8 @@
-from .combine_slices import combine_slices
+from .combine_slices import combine_slices, combine_slices_from_paths
 from .exceptions import DicomImportException
 
 __all__ = [
     combine_slices,
+    combine_slices_from_paths,
     DicomImportException,
 ]
@@ -1,14 +1,32 @@
+import functools
 import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
 
+try:
+    import numba
+except ImportError:
+    numba = None
+
 from .utils import isclose
 from .exceptions import DicomImportException
 
 logger = logging.getLogger(__name__)
 
+if numba is not None:
+    @numba.njit(nogil=True, cache=True)
+    def _rescale_slice_jit(pixel_array, slope, intercept, out):
+        num_rows, num_columns = pixel_array.shape
+        for i in range(num_rows):
+            for j in range(num_columns):
+                out[i, j] = pixel_array[i, j]*slope + intercept
+else:
+    _rescale_slice_jit = None
+
 
-def combine_slices(slice_datasets):
+def combine_slices(slice_datasets, keep_pixel_data=False):
     '''
     Given a list of pydicom datasets for an image series, stitch them together into a
     three-dimensional numpy array.  Also calculate a 4x4 affine transformation
@@ -55,56 +73,248 @@ def combine_slices(slice_datasets):
       values must approximately form a line.
 
     If any of these conditions are not met, a `dicom_numpy.DicomImportException` is raised.
+
+    Note that by default the pixel data held by the input datasets is released
+    as each slice is copied into the volume, since for a long series these
+    per-slice buffers rival the output volume in size.  Pass
+    `keep_pixel_data=True` to leave the input datasets untouched.
     '''
     if len(slice_datasets) == 0:
         raise DicomImportException("Must provide at least one DICOM dataset")
 
-    _validate_slices_form_uniform_grid(slice_datasets)
+    # the direction cosines, slice positions, and sort order are needed by
+    # validation, merging, and the affine alike; compute them once instead of
+    # re-deriving them from the datasets in each helper
+    cosines = _extract_cosines(slice_datasets[0].ImageOrientationPatient)
+    slice_positions = _slice_positions(slice_datasets, cosines[2])
+    slice_spacing = _validate_slices_form_uniform_grid(slice_datasets, slice_positions, cosines)
 
-    voxels = _merge_slice_pixel_arrays(slice_datasets)
-    transform = _ijk_to_patient_xyz_transform_matrix(slice_datasets)
+    sorted_slice_datasets = _sort_by_slice_spacing(slice_datasets, slice_positions)
+
+    voxels = _merge_slice_pixel_arrays(sorted_slice_datasets, keep_pixel_data)
+    transform = _ijk_to_patient_xyz_transform_matrix(sorted_slice_datasets, slice_spacing, cosines)
 
     return voxels, transform
 
 
-def _merge_slice_pixel_arrays(slice_datasets):
-    first_dataset = slice_datasets[0]
-    num_rows = first_dataset.Rows
-    num_columns = first_dataset.Columns
-    num_slices = len(slice_datasets)
-
-    sorted_slice_datasets = _sort_by_slice_spacing(slice_datasets)
-
-    if any(_requires_rescaling(d) for d in sorted_slice_datasets):
-        voxels = np.empty((num_columns, num_rows, num_slices), dtype=np.float32)
-        for k, dataset in enumerate(sorted_slice_datasets):
-            # MM fix 13.09, handling RescaleSlope/Intercept attributes present but with empty value
-            slope = getattr(dataset, 'RescaleSlope', 1)
-            slope = float(slope) if slope != '' else 1
-            intercept = getattr(dataset, 'RescaleIntercept', 0)
-            intercept = float(intercept) if intercept != '' else 0
-            voxels[:, :, k] = dataset.pixel_array.T.astype(np.float32)*slope + intercept
+def combine_slices_from_paths(slice_paths):
+    '''
+    Like `combine_slices`, but takes paths to the DICOM files instead of
+    already-loaded pydicom datasets.
+
+    The files are first read header-only (`stop_before_pixels=True`) to
+    validate the grid, sort the slices, and size the volume; the pixel data is
+    then streamed into the volume one slice per worker and dropped as soon as
+    it is copied.  Peak memory stays near the output volume itself, instead of
+    the roughly three volumes held when every dataset is fully loaded up
+    front.
+    '''
+    # imported here so the rest of the module keeps working on
+    # already-loaded datasets without a pydicom installation
+    import pydicom
+
+    if len(slice_paths) == 0:
+        raise DicomImportException("Must provide at least one DICOM file path")
+
+    headers = [pydicom.dcmread(path, stop_before_pixels=True) for path in slice_paths]
+
+    cosines = _extract_cosines(headers[0].ImageOrientationPatient)
+    slice_positions = _slice_positions(headers, cosines[2])
+    slice_spacing = _validate_slices_form_uniform_grid(headers, slice_positions, cosines)
+
+    order = np.argsort(slice_positions, kind='stable')
+    sorted_paths = [slice_paths[i] for i in order]
+    sorted_headers = [headers[i] for i in order]
+    num_slices = len(sorted_paths)
+
+    first_dataset = pydicom.dcmread(sorted_paths[0])
+    first_pixel_array, dtype, slopes, intercepts, write_slice = _plan_merge(
+        first_dataset, sorted_headers)
+    num_rows, num_columns = first_pixel_array.shape
+
+    voxels = np.empty((num_slices, num_rows, num_columns), dtype=dtype)
+
+    def read_and_write(out, k, path, dataset=None):
+        if dataset is None:
+            dataset = pydicom.dcmread(path)
+        write_slice(out, dataset.pixel_array, slopes[k], intercepts[k])
+
+    with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+        futures = [executor.submit(read_and_write, voxels[k], k, path,
+                                   first_dataset if k == 0 else None)
+                   for k, path in enumerate(sorted_paths)]
+        for future in futures:
+            future.result()
+
+    transform = _ijk_to_patient_xyz_transform_matrix(sorted_headers, slice_spacing, cosines)
+
+    return voxels.transpose(2, 1, 0), transform
+
+
+def _merge_slice_pixel_arrays(sorted_slice_datasets, keep_pixel_data=False):
+    num_slices = len(sorted_slice_datasets)
+    if num_slices == 0:
+        # combine_slices rejects empty input before reaching here, but a
+        # zero-byte broadcast view is cheaper than np.empty's backing buffer
+        return np.broadcast_to(np.zeros((), dtype=np.float32), (0, 0, 0))
+
+    first_pixel_array, dtype, slopes, intercepts, write_slice = _plan_merge(
+        sorted_slice_datasets[0], sorted_slice_datasets)
+    num_rows, num_columns = first_pixel_array.shape
+
+    # each pixel_array is a C-contiguous (rows, columns) array; allocating the
+    # volume slice-major lets it be copied in without the strided `.T` copy,
+    # and the transposed view returned below restores the public axis order
+    voxels = np.empty((num_slices, num_rows, num_columns), dtype=dtype)
+
+    def write_and_release(out, k, dataset):
+        write_slice(out, dataset.pixel_array, slopes[k], intercepts[k])
+        if not keep_pixel_data:
+            _drop_pixel_data(dataset)
+
+    # pydicom decompression and the numpy conversions release the GIL, so
+    # decoding slices on a thread pool scales with the available cores;
+    # iterating the volume hands each worker its contiguous destination
+    # frame directly, with no per-slice index arithmetic in the loop
+    with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+        futures = [executor.submit(write_and_release, out, k, dataset)
+                   for k, (out, dataset) in enumerate(zip(voxels, sorted_slice_datasets))]
+        for future in futures:
+            future.result()
+
+    return voxels.transpose(2, 1, 0)
+
+
+def _plan_merge(first_dataset, sorted_slice_datasets):
+    '''
+    Decode the first slice and resolve everything the merge loop needs: the
+    decoded array, the output dtype, the per-slice rescale parameters, and
+    the copy kernel.  Decoding before the volume is allocated means a decode
+    failure cannot leave a throwaway volume-sized buffer in flight, and the
+    volume is sized from the decoded shape rather than trusting the header.
+
+    `sorted_slice_datasets` supplies the rescale metadata; it may hold
+    header-only datasets, as long as `first_dataset` carries pixel data.
+    '''
+    first_pixel_array = first_dataset.pixel_array
+    if first_pixel_array.shape != (first_dataset.Rows, first_dataset.Columns):
+        msg = 'Decoded pixel data shape {} does not match Rows/Columns {}'
+        raise DicomImportException(msg.format(
+            first_pixel_array.shape, (first_dataset.Rows, first_dataset.Columns)))
+
+    num_slices = len(sorted_slice_datasets)
+    needs_rescaling = any(_requires_rescaling(d) for d in sorted_slice_datasets)
+    if needs_rescaling:
+        slopes, intercepts = zip(*(_rescale_parameters(d) for d in sorted_slice_datasets))
+        dtype = _rescaled_dtype(first_pixel_array.dtype, slopes, intercepts)
     else:
-        dtype = first_dataset.pixel_array.dtype
-        voxels = np.empty((num_columns, num_rows, num_slices), dtype=dtype)
-        for k, dataset in enumerate(sorted_slice_datasets):
-            voxels[:, :, k] = dataset.pixel_array.T
+        slopes = (1.0,)*num_slices
+        intercepts = (0.0,)*num_slices
+        dtype = first_pixel_array.dtype
+
+    integer_shift = needs_rescaling and bool(np.issubdtype(dtype, np.integer))
+    write_slice = _select_slice_kernel(needs_rescaling, integer_shift)
+
+    return first_pixel_array, dtype, slopes, intercepts, write_slice
+
+
+def _copy_slice(out, pixel_array, slope, intercept):
+    out[...] = pixel_array
+
+
+def _shift_slice(out, pixel_array, slope, intercept):
+    # bind the intercept to the output dtype: a bare Python int would make
+    # numpy compute the sum in the source dtype, overflowing it (or, for a
+    # negative intercept with unsigned pixels, refusing outright) even though
+    # _rescaled_dtype widened the volume to hold the result
+    np.add(pixel_array, out.dtype.type(int(intercept)), out=out, casting='unsafe')
 
-    return voxels
+
+def _rescale_slice_numpy(out, pixel_array, slope, intercept):
+    # writing through `out=` upcasts on the fly, avoiding the
+    # astype/multiply/add temporaries of the naive expression
+    np.multiply(pixel_array, np.float32(slope), out=out, casting='unsafe')
+    np.add(out, np.float32(intercept), out=out)
+
+
+def _rescale_slice_numba(out, pixel_array, slope, intercept):
+    # numba cannot type non-native byte orders, which pydicom produces for
+    # Explicit VR Big Endian files; those slices take the numpy kernel
+    if not pixel_array.dtype.isnative:
+        return _rescale_slice_numpy(out, pixel_array, slope, intercept)
+    # the JIT kernel fuses the multiply and add into one pass and runs
+    # without the GIL, so the thread pool keeps all cores busy; numba
+    # specializes and disk-caches it per source dtype
+    _rescale_slice_jit(pixel_array, np.float32(slope), np.float32(intercept), out)
+
+
+@functools.lru_cache(maxsize=None)
+def _select_slice_kernel(needs_rescaling, integer_shift):
+    '''
+    Resolve the per-slice copy kernel once per merge, so the copy loop itself
+    carries no dtype or rescale branching.
+    '''
+    if not needs_rescaling:
+        return _copy_slice
+    if integer_shift:
+        return _shift_slice
+    if _rescale_slice_jit is not None:
+        return _rescale_slice_numba
+    return _rescale_slice_numpy
+
+
+def _drop_pixel_data(dataset):
+    '''
+    Release the pixel buffers a slice holds once it has been copied into the
+    volume: both pydicom's decoded pixel_array cache and the raw PixelData
+    bytes.
+    '''
+    dataset._pixel_array = None
+    if 'PixelData' in dataset:
+        dataset.PixelData = None
+
+
+def _rescale_parameters(dataset):
+    # MM fix 13.09, handling RescaleSlope/Intercept attributes present but with empty value
+    slope = dataset.get('RescaleSlope', 1)
+    slope = float(slope) if slope != '' else 1
+    intercept = dataset.get('RescaleIntercept', 0)
+    intercept = float(intercept) if intercept != '' else 0
+    return slope, intercept
+
+
+def _rescaled_dtype(pixel_dtype, slopes, intercepts):
+    '''
+    Pick the output dtype for the rescale path.  When every slope is 1 and
+    every intercept is a whole number (the common CT case: slope=1,
+    intercept=-1024), the rescale is a pure integer shift, so the volume can
+    stay integral at half the memory of float32.  The dtype is widened if the
+    shift could overflow the source dtype; anything that would not fit in a
+    32-bit integer falls back to float32.
+    '''
+    integral_shift = (np.issubdtype(pixel_dtype, np.integer)
+                      and all(slope == 1 for slope in slopes)
+                      and all(float(intercept).is_integer() for intercept in intercepts))
+    if integral_shift:
+        lowest = np.iinfo(pixel_dtype).min + int(min(intercepts))
+        highest = np.iinfo(pixel_dtype).max + int(max(intercepts))
+        dtype = np.result_type(pixel_dtype, np.min_scalar_type(lowest), np.min_scalar_type(highest))
+        if dtype.itemsize <= 4:
+            return dtype
+    return np.dtype(np.float32)
 
 
 def _requires_rescaling(dataset):
-    return ((hasattr(dataset, 'RescaleSlope') and getattr(dataset, 'RescaleSlope') != '')
-           or (hasattr(dataset, 'RescaleIntercept') and getattr(dataset, 'RescaleIntercept') != ''))
+    # Dataset.get is a plain tag lookup, unlike hasattr which goes through
+    # pydicom's exception-raising __getattr__
+    return dataset.get('RescaleSlope', '') != '' or dataset.get('RescaleIntercept', '') != ''
 
 
-def _ijk_to_patient_xyz_transform_matrix(slice_datasets):
-    first_dataset = _sort_by_slice_spacing(slice_datasets)[0]
-    image_orientation = first_dataset.ImageOrientationPatient
-    row_cosine, column_cosine, slice_cosine = _extract_cosines(image_orientation)
+def _ijk_to_patient_xyz_transform_matrix(sorted_slice_datasets, slice_spacing, cosines):
+    first_dataset = sorted_slice_datasets[0]
+    row_cosine, column_cosine, slice_cosine = cosines
 
     row_spacing, column_spacing = first_dataset.PixelSpacing
-    slice_spacing = _slice_spacing(slice_datasets)
 
     transform = np.identity(4, dtype=np.float32)
 
@@ -117,12 +327,14 @@ def _ijk_to_patient_xyz_transform_matrix(slice_datasets):
     return transform
 
 
-def _validate_slices_form_uniform_grid(slice_datasets):
+def _validate_slices_form_uniform_grid(slice_datasets, slice_positions, cosines):
     '''
     Perform various data checks to ensure that the list of slices form a
     evenly-spaced grid of data.
     Some of these checks are probably not required if the data follows the
     DICOM specification, however it seems pertinent to check anyway.
+
+    Returns the mean slice spacing.
     '''
     invariant_properties = [
         'Modality',
@@ -141,35 +353,41 @@ def _validate_slices_form_uniform_grid(slice_datasets):
     for property_name in invariant_properties:
         _slice_attribute_equal(slice_datasets, property_name)
 
-    _validate_image_orientation(slice_datasets[0].ImageOrientationPatient)
+    _validate_image_orientation(cosines)
 
-    slice_positions = _slice_positions(slice_datasets)
-    _check_for_missing_slices(slice_positions)
+    return _check_for_missing_slices(slice_positions)
 
 
-def _validate_image_orientation(image_orientation):
+def _validate_image_orientation(cosines):
     '''
     Ensure that the image orientation is supported
     - The direction cosines have magnitudes of 1 (just in case)
     - The direction cosines are perpendicular
     '''
-    # TODO: deduplicate this
-    row_cosine, column_cosine, slice_cosine = _extract_cosines(image_orientation)
+    row_cosine, column_cosine, slice_cosine = cosines
+
+    # compute the dot product and norms once and compare each against both
+    # the hard and the warning threshold
+    cosines_dot = np.dot(row_cosine, column_cosine)
+    row_cosine_norm = np.linalg.norm(row_cosine)
+    column_cosine_norm = np.linalg.norm(column_cosine)
 
-    if not _almost_zero(np.dot(row_cosine, column_cosine), 1e-4):
+    if not _almost_zero(cosines_dot, 1e-4):
         raise DicomImportException("Non-orthogonal direction cosines: {}, {}".format(row_cosine, column_cosine))
-    elif not _almost_zero(np.dot(row_cosine, column_cosine), 1e-8):
-        logger.warn("Direction cosines aren't quite orthogonal: {}, {}".format(row_cosine, column_cosine))
+    elif not _almost_zero(cosines_dot, 1e-8):
+        # the lazy %s form defers stringifying the arrays until a handler
+        # actually accepts the record
+        logger.warning("Direction cosines aren't quite orthogonal: %s, %s", row_cosine, column_cosine)
 
-    if not _almost_one(np.linalg.norm(row_cosine), 1e-4):
+    if not _almost_one(row_cosine_norm, 1e-4):
         raise DicomImportException("The row direction cosine's magnitude is not 1: {}".format(row_cosine))
-    elif not _almost_one(np.linalg.norm(row_cosine), 1e-8):
-        logger.warn("The row direction cosine's magnitude is not quite 1: {}".format(row_cosine))
+    elif not _almost_one(row_cosine_norm, 1e-8):
+        logger.warning("The row direction cosine's magnitude is not quite 1: %s", row_cosine)
 
-    if not _almost_one(np.linalg.norm(column_cosine), 1e-4):
+    if not _almost_one(column_cosine_norm, 1e-4):
         raise DicomImportException("The column direction cosine's magnitude is not 1: {}".format(column_cosine))
-    elif not _almost_one(np.linalg.norm(column_cosine), 1e-8):
-        logger.warn("The column direction cosine's magnitude is not quite 1: {}".format(column_cosine))
+    elif not _almost_one(column_cosine_norm, 1e-8):
+        logger.warning("The column direction cosine's magnitude is not quite 1: %s", column_cosine)
 
 
 def _almost_zero(value, abs_tol):
@@ -181,81 +399,87 @@ def _almost_one(value, abs_tol):
 
 
 def _extract_cosines(image_orientation):
-    row_cosine = np.array(image_orientation[:3])
-    column_cosine = np.array(image_orientation[3:])
+    # a single float64 conversion of the whole six-element attribute; slicing
+    # the result is cheaper than inferring a dtype for each half separately
+    orientation = np.asarray(image_orientation, dtype=np.float64)
+    row_cosine = orientation[:3]
+    column_cosine = orientation[3:]
     slice_cosine = np.cross(row_cosine, column_cosine)
     return row_cosine, column_cosine, slice_cosine
 
 
-def is_float(val):
-    try:
-        float(val)
-        return True
-    except ValueError:
-        return False
-
-def is_iterable(val):
-    try:
-        iter(val)
-        return True
-    except TypeError:
-        return False
-
-
-def _lsts_roughly_equal(lst1, lst2):
-    if not is_iterable(lst1):
-        return lst1 == lst2
-    if len(lst1) != len(lst2):
-        return False
-    error_margin = 0.001
-    for lst1_el, lst2_el in zip(lst1, lst2):
-        if is_float(lst1_el):
-            if not float(lst1_el) - error_margin <= float(lst2_el) <= float(lst1_el) + error_margin:
-                return False
-        else:
-            if lst1_el != lst2_el:
-                return False
-    return True
+# DICOM value representations holding numeric data; everything else (UIDs,
+# code strings, ...) is compared exactly
+_NUMERIC_VRS = frozenset(('DS', 'FL', 'FD', 'IS', 'SL', 'SS', 'UL', 'US'))
 
 
 def _slice_attribute_equal(slice_datasets, property_name):
     if property_name == 'SeriesInstanceUID':
         return
-    initial_value = getattr(slice_datasets[0], property_name, None)
+
+    first_dataset = slice_datasets[0]
+    data_element = first_dataset[property_name] if property_name in first_dataset else None
+    initial_value = data_element.value if data_element is not None else None
+
+    # the element's VR says outright whether the attribute is numeric, so
+    # there is no need to probe each value with float()
+    is_numeric = data_element is not None and data_element.VR in _NUMERIC_VRS
+    if is_numeric:
+        initial_array = np.atleast_1d(np.asarray(initial_value, dtype=float))
+
     for dataset in slice_datasets[1:]:
-        value = getattr(dataset, property_name, None)
-        # (MM 28.08), fix for different values error caused by floating point inprecision
-        if not _lsts_roughly_equal(value, initial_value):
+        value = dataset.get(property_name, None)
+        if is_numeric and value is not None:
+            # (MM 28.08), fix for different values error caused by floating point inprecision
+            value_array = np.atleast_1d(np.asarray(value, dtype=float))
+            equal = (value_array.shape == initial_array.shape
+                     and bool(np.allclose(value_array, initial_array, rtol=0, atol=0.001)))
+        else:
+            equal = value == initial_value
+        if not equal:
             msg = 'All slices must have the same value for "{}": {} != {}'
             raise DicomImportException(msg.format(property_name, value, initial_value))
 
 
-def _slice_positions(slice_datasets):
-    image_orientation = slice_datasets[0].ImageOrientationPatient
-    row_cosine, column_cosine, slice_cosine = _extract_cosines(image_orientation)
-    return [np.dot(slice_cosine, d.ImagePositionPatient) for d in slice_datasets]
+def _slice_positions(slice_datasets, slice_cosine):
+    image_positions = np.array([d.ImagePositionPatient for d in slice_datasets], dtype=float)
+    # one (N, 3) x (3,) product instead of a Python-level dot per slice
+    return np.dot(image_positions, slice_cosine).tolist()
 
 
 def _check_for_missing_slices(slice_positions):
-    slice_positions_diffs = np.diff(sorted(slice_positions))
-    if not np.allclose(slice_positions_diffs, slice_positions_diffs[0], atol=0, rtol=1e-5):
+    '''
+    Check that the slice positions are uniformly spaced, and return the mean
+    slice spacing so that callers do not have to re-derive it from the
+    positions.
+    '''
+    num_slices = len(slice_positions)
+    if num_slices <= 1:
+        return 0.0
+
+    sorted_positions = np.sort(slice_positions)
+    slice_spacing = (sorted_positions[-1] - sorted_positions[0])/(num_slices - 1)
+
+    # compare against the ideal evenly-spaced line rather than pairwise
+    # diffs; a missing slice shows up as a residual jump of about one spacing
+    ideal_positions = sorted_positions[0] + slice_spacing*np.arange(num_slices)
+    max_residual = np.abs(sorted_positions - ideal_positions).max()
+
+    if max_residual > abs(slice_spacing)*1e-5:
         # TODO: figure out how we should handle non-even slice spacing
-        msg = "The slice spacing is non-uniform. Slice spacings:\n{}"
-        logger.warn(msg.format(slice_positions_diffs))
+        if logger.isEnabledFor(logging.WARNING):
+            # the diffs are only needed for the message, so skip both them
+            # and the ndarray stringification when warnings are off
+            logger.warning("The slice spacing is non-uniform. Slice spacings:\n%s",
+                           np.diff(sorted_positions))
 
-    if not np.allclose(slice_positions_diffs, slice_positions_diffs[0], atol=0, rtol=1e-1):
+    if max_residual > abs(slice_spacing)*1e-1:
         raise DicomImportException('It appears there are missing slices')
 
-
-def _slice_spacing(slice_datasets):
-    if len(slice_datasets) > 1:
-        slice_positions = _slice_positions(slice_datasets)
-        slice_positions_diffs = np.diff(sorted(slice_positions))
-        return np.mean(slice_positions_diffs)
-    else:
-        return 0.0
+    return slice_spacing
 
 
-def _sort_by_slice_spacing(slice_datasets):
-    slice_spacing = _slice_positions(slice_datasets)
-    return [d for (s, d) in sorted(zip(slice_spacing, slice_datasets))]
+def _sort_by_slice_spacing(slice_datasets, slice_positions):
+    # argsort keeps the comparisons at the C level; sorted(zip(...)) would
+    # fall back to comparing the Dataset objects themselves on ties
+    return [slice_datasets[i] for i in np.argsort(slice_positions, kind='stable')]
@@ -0,0 +1,65 @@
+import numpy as np
+from pydicom.dataset import Dataset, FileMetaDataset
+from pydicom.uid import ExplicitVRLittleEndian
+
+from dicom_numpy import combine_slices
+
+
+def make_slice(pixel_array, slice_position, slope=None, intercept=None):
+    dataset = Dataset()
+    dataset.file_meta = FileMetaDataset()
+    dataset.file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+    dataset.Modality = 'CT'
+    dataset.SOPClassUID = '1.2.840.10008.5.1.4.1.1.2'
+    dataset.SeriesInstanceUID = '1.2.3'
+    dataset.Rows, dataset.Columns = pixel_array.shape
+    dataset.SamplesPerPixel = 1
+    dataset.PhotometricInterpretation = 'MONOCHROME2'
+    dataset.BitsAllocated = 16
+    dataset.BitsStored = 16
+    dataset.HighBit = 15
+    dataset.PixelRepresentation = 0 if pixel_array.dtype == np.uint16 else 1
+    dataset.ImageOrientationPatient = [1, 0, 0, 0, 1, 0]
+    dataset.PixelSpacing = [0.5, 0.75]
+    dataset.ImagePositionPatient = [0, 0, slice_position]
+    if slope is not None:
+        dataset.RescaleSlope = slope
+    if intercept is not None:
+        dataset.RescaleIntercept = intercept
+    dataset.PixelData = pixel_array.tobytes()
+    return dataset
+
+
+def test_unsigned_pixels_with_negative_integer_intercept():
+    # the common CT storage: unsigned pixels shifted by a negative intercept
+    arrays = [np.array([[0, 1024], [3000, 65535]], dtype=np.uint16) + k
+              for k in range(3)]
+    datasets = [make_slice(arr, 2.0*k, slope='1', intercept='-1024')
+                for k, arr in enumerate(arrays)]
+
+    voxels, _ = combine_slices(datasets)
+
+    assert np.issubdtype(voxels.dtype, np.integer)
+    for k, arr in enumerate(arrays):
+        np.testing.assert_array_equal(
+            np.asarray(voxels[:, :, k], dtype=np.int64),
+            arr.T.astype(np.int64) - 1024,
+        )
+
+
+def test_integer_shift_that_overflows_the_source_dtype():
+    # near-rail values must be shifted in the widened output dtype, not wrap
+    # around in the source dtype
+    arrays = [np.array([[32000, -32000], [0, 1]], dtype=np.int16)
+              for _ in range(2)]
+    datasets = [make_slice(arr, 2.0*k, slope='1', intercept='1000')
+                for k, arr in enumerate(arrays)]
+
+    voxels, _ = combine_slices(datasets)
+
+    assert np.issubdtype(voxels.dtype, np.integer)
+    for k, arr in enumerate(arrays):
+        np.testing.assert_array_equal(
+            np.asarray(voxels[:, :, k], dtype=np.int64),
+            arr.T.astype(np.int64) + 1000,
+        )